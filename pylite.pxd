@@ -0,0 +1,10 @@
+# declarations for compiling pylite.py with Cython in pure Python mode
+
+cdef class PyliteInterpreter:
+    cdef public object last_value
+    cdef public dict env
+    cdef dict _slots
+    cdef list _values
+    cdef dict _dispatch
+    cdef dict _compilers
+    cpdef visit(self, node)
@@ -1,27 +1,135 @@
+import ast
 import operator
 from argparse import ArgumentParser
-from ast import parse, NodeVisitor
-from random import randrange
-from os.path import exists as file_exists
+from copy import deepcopy
+from functools import lru_cache
+from importlib.util import find_spec
+from ast import parse, NodeTransformer, Constant, BinOp, Add, Sub, Mult, Div
+from random import randrange, getrandbits
+from textwrap import indent
 
 # see https://docs.python.org/dev/library/ast.html#abstract-grammar
 
-class PyliteInterpreter(NodeVisitor):
+# marks variables that have not been assigned yet
+_UNSET = object()
+
+@lru_cache(maxsize=128)
+def _parse_source(code):
+    return parse(code)
+
+def _parse_program(code_or_tree):
+    # parse source code, reusing the tree if the same source was parsed before
+    if isinstance(code_or_tree, ast.AST):
+        return code_or_tree
+    return _parse_source(code_or_tree)
+
+def _parse_private(code_or_tree):
+    # parse source code into a tree that is not shared with the cache (or
+    # with the caller), so that it can be annotated
+    if isinstance(code_or_tree, ast.AST):
+        return deepcopy(code_or_tree)
+    return parse(code_or_tree)
+
+def _is_number(node):
+    return type(node) is Constant and type(node.value) in (int, float)
+
+def _unsupported(node):
+    # compile unsupported syntax to a thunk that fails when it is run, as
+    # visiting it would, so code that never runs does not stop the program
+    def thunk():
+        raise NotImplementedError('Unsupported syntax `{}`'.format(type(node).__name__))
+    return thunk
+
+
+def _safe_to_fold(op, operands):
+    # like CPython's optimizer, refuse to fold operations whose result could
+    # be huge, since folding happens even for code that never runs
+    if op is ast.Pow:
+        base, exponent = operands
+        if isinstance(base, int) and isinstance(exponent, int) and exponent > 0:
+            return base.bit_length() * exponent <= 128
+    elif op is ast.Mult:
+        left, right = operands
+        for sequence, count in ((left, right), (right, left)):
+            if isinstance(sequence, (str, bytes, tuple)) and isinstance(count, int):
+                return len(sequence) * count <= 4096
+    return True
+
+class PyliteInterpreter:
     BUILTINS = {
         'print':print
     }
+    _OPS = {
+        ast.Add: operator.add,
+        ast.Sub: operator.sub,
+        ast.Mult: operator.mul,
+        ast.Div: operator.truediv,
+        ast.FloorDiv: operator.floordiv,
+        ast.Mod: operator.mod,
+        ast.Pow: operator.pow,
+        ast.Not: operator.not_,
+        ast.UAdd: operator.pos,
+        ast.USub: operator.neg,
+        ast.Lt: operator.lt,
+        ast.LtE: operator.le,
+        ast.Eq: operator.eq,
+        ast.NotEq: operator.ne,
+        ast.GtE: operator.ge,
+        ast.Gt: operator.gt,
+    }
     def __init__(self):
-        super().__init__()
         self.last_value = None
         self.env = {}
+        # compiled programs keep variables in a list instead, with each name
+        # resolved to an index when it is compiled
+        self._slots = {}
+        self._values = []
+        # map node types directly to (possibly overridden) visitor methods
+        self._dispatch = {}
+        for attr in dir(self):
+            if attr.startswith('visit_') and hasattr(ast, attr[6:]):
+                self._dispatch[getattr(ast, attr[6:])] = getattr(self, attr)
+        # likewise for the closure compilers
+        self._compilers = {}
+        for attr in dir(self):
+            if attr.startswith('_compile_') and hasattr(ast, attr[9:]):
+                self._compilers[getattr(ast, attr[9:])] = getattr(self, attr)
+    def _annotate(self, tree):
+        # attach the function for each operator to the node using it, so
+        # visiting the node does not need to look the operator up again;
+        # visitors fall back to _OPS for trees that were not annotated
+        # (which is also left to raise for unsupported operators)
+        ops = self._OPS
+        for node in ast.walk(tree):
+            if type(node) is ast.Compare:
+                if all(type(op) in ops for op in node.ops):
+                    node._op_fns = [ops[type(op)] for op in node.ops]
+            elif type(node) in (ast.BinOp, ast.UnaryOp, ast.AugAssign):
+                if type(node.op) in ops:
+                    node._op_fn = ops[type(node.op)]
+    def visit(self, node):
+        visitor = self._dispatch.get(type(node))
+        if visitor is None:
+            raise NotImplementedError('Unsupported syntax `{}`'.format(type(node).__name__))
+        return visitor(node)
+    def visit_Module(self, node):
+        for statement in node.body:
+            self.visit(statement)
+    def visit_Expr(self, node):
+        self.visit(node.value)
+    def visit_Pass(self, node):
+        pass
     def visit_Call(self, node):
+        visit = self.visit
+        env = self.env
+        builtins = PyliteInterpreter.BUILTINS
         function = node.func.id
-        if function in PyliteInterpreter.BUILTINS:
-            args = [self.visit(arg) for arg in node.args]
-            return PyliteInterpreter.BUILTINS[function](*args)
-        elif function in self.env:
-            args = [self.visit(arg) for arg in node.args]
-            return self.env[function](*args)
+        if function in builtins:
+            args = [visit(arg) for arg in node.args]
+            return builtins[function](*args)
+        elif function in env:
+            args = [visit(arg) for arg in node.args]
+            return env[function](*args)
         else:
             raise NameError('Undefined function `{}`'.format(function))
     def visit_Name(self, node):
@@ -32,7 +140,17 @@ class PyliteInterpreter(NodeVisitor):
     def visit_Assign(self, node):
         self.env[node.targets[0].id] = self.visit(node.value)
     def visit_AugAssign(self, node):
-        self.env[node.target.id] = self.visit(node.op)(self.visit(node.target), self.visit(node.value))
+        name = node.target.id
+        env = self.env
+        try:
+            value = env[name]
+        except KeyError:
+            raise NameError('Undefined variable `{}`'.format(name)) from None
+        try:
+            op = node._op_fn
+        except AttributeError:
+            op = self._OPS[type(node.op)]
+        env[name] = op(value, self.visit(node.value))
     def visit_BoolOp(self, node):
         if type(node.op).__name__ == 'And':
             for value in node.values:
@@ -46,61 +164,35 @@ class PyliteInterpreter(NodeVisitor):
             return False
         else:
             raise NotImplementedError('Unknown boolean operator `{}`'.format(type(node.op).__name__))
-    def visit_NameConstant(self, node):
-        return node.value
     def visit_Compare(self, node):
-        ops = [self.visit(op) for op in node.ops]
-        prev_value = self.visit(node.left)
-        for i in range(len(ops)):
-            next_value = self.visit(node.comparators[i])
-            if not ops[i](prev_value, next_value):
+        visit = self.visit
+        try:
+            ops = node._op_fns
+        except AttributeError:
+            ops = [self._OPS[type(op)] for op in node.ops]
+        prev_value = visit(node.left)
+        for op, comparator in zip(ops, node.comparators):
+            next_value = visit(comparator)
+            if not op(prev_value, next_value):
                 return False
             prev_value = next_value
         return True
-    def visit_Lt(self, node):
-        return operator.lt
-    def visit_Le(self, node):
-        return operator.le
-    def visit_Eq(self, node):
-        return operator.eq
-    def visit_Ne(self, node):
-        return operator.ne
-    def visit_Ge(self, node):
-        return operator.ge
-    def visit_Gt(self, node):
-        return operator.gt
     def visit_BinOp(self, node):
-        args = [self.visit(node.left), self.visit(node.right)]
-        op = self.visit(node.op)
-        return op(*args)
-    def visit_Add(self, node):
-        return operator.add
-    def visit_Sub(self, node):
-        return operator.sub
-    def visit_Mult(self, node):
-        return operator.mul
-    def visit_Div(self, node):
-        return operator.truediv
-    def visit_FloorDiv(self, node):
-        return operator.floordiv
-    def visit_Mod(self, node):
-        return operator.mod
-    def visit_Pow(self, node):
-        return operator.pow
+        try:
+            op = node._op_fn
+        except AttributeError:
+            op = self._OPS[type(node.op)]
+        return op(self.visit(node.left), self.visit(node.right))
     def visit_UnaryOp(self, node):
-        return self.visit(node.op)(self.visit(node.operand))
-    def visit_Not(self, node):
-        return operator.not_
-    def visit_UAdd(self, node):
-        return operator.pos
-    def visit_USub(self, node):
-        return operator.neg
+        try:
+            op = node._op_fn
+        except AttributeError:
+            op = self._OPS[type(node.op)]
+        return op(self.visit(node.operand))
 
 
-    def visit_Str(self, node):
-        return node.s
-    def visit_Num(self, node):
-        return node.n
+    def visit_Constant(self, node):
+        return node.value
 
     def visit_If(self, node):
         test_result = self.visit(node.test)
@@ -111,42 +203,388 @@ class PyliteInterpreter(NodeVisitor):
             for else_statement in node.orelse:
                 self.visit(else_statement)
     def visit_While(self, node):
-        test_result = self.visit(node.test)
-        while test_result:
-            for statement in node.body:
+        visit = self.visit
+        test = node.test
+        body = node.body
+        while visit(test):
+            for statement in body:
                 # FIXME this doesn't deal with breaks
-                self.visit(statement)
-            test_result = self.visit(node.test)
+                visit(statement)
+
+    # compile the AST once into a tree of zero-argument closures, so running
+    # the program no longer re-dispatches on every node it visits
+    def _slot(self, name):
+        if name not in self._slots:
+            self._slots[name] = len(self._values)
+            self._values.append(_UNSET)
+        return self._slots[name]
+    def _compile(self, node):
+        compiler = self._compilers.get(type(node))
+        if compiler is None:
+            return lambda: self.visit(node)
+        return compiler(node)
+    def _compile_body(self, statements):
+        # compile a block of statements into a single thunk
+        body = tuple(self._compile(statement) for statement in statements)
+        if len(body) == 0:
+            return lambda: None
+        elif len(body) == 1:
+            return body[0]
+        def thunk():
+            for statement in body:
+                statement()
+        return thunk
+    def _compile_Module(self, node):
+        return self._compile_body(node.body)
+    def _compile_Expr(self, node):
+        return self._compile(node.value)
+    def _compile_Call(self, node):
+        if not isinstance(node.func, ast.Name):
+            return _unsupported(node.func)
+        function = node.func.id
+        args = [self._compile(arg) for arg in node.args]
+        if function in PyliteInterpreter.BUILTINS:
+            # builtins take precedence over variables, so bind them now
+            builtin = PyliteInterpreter.BUILTINS[function]
+            if len(args) == 0:
+                return builtin
+            elif len(args) == 1:
+                arg, = args
+                return lambda: builtin(arg())
+            elif len(args) == 2:
+                arg0, arg1 = args
+                return lambda: builtin(arg0(), arg1())
+            return lambda: builtin(*[arg() for arg in args])
+        values = self._values
+        slot = self._slot(function)
+        def thunk():
+            value = values[slot]
+            if value is _UNSET:
+                raise NameError('Undefined function `{}`'.format(function))
+            return value(*[arg() for arg in args])
+        return thunk
+    def _compile_Name(self, node):
+        values = self._values
+        name = node.id
+        slot = self._slot(name)
+        def thunk():
+            value = values[slot]
+            if value is _UNSET:
+                raise NameError('Undefined variable `{}`'.format(name))
+            return value
+        return thunk
+    def _compile_Assign(self, node):
+        values = self._values
+        slot = self._slot(node.targets[0].id)
+        value = self._compile(node.value)
+        def thunk():
+            values[slot] = value()
+        return thunk
+    def _compile_AugAssign(self, node):
+        values = self._values
+        name = node.target.id
+        slot = self._slot(name)
+        op = self._OPS.get(type(node.op))
+        if op is None:
+            return _unsupported(node.op)
+        value = self._compile(node.value)
+        def thunk():
+            target = values[slot]
+            if target is _UNSET:
+                raise NameError('Undefined variable `{}`'.format(name))
+            values[slot] = op(target, value())
+        return thunk
+    def _compile_BoolOp(self, node):
+        values = [self._compile(value) for value in node.values]
+        if type(node.op) is ast.And:
+            return lambda: all(value() for value in values)
+        elif type(node.op) is ast.Or:
+            return lambda: any(value() for value in values)
+        else:
+            return _unsupported(node.op)
+    def _compile_Compare(self, node):
+        for op in node.ops:
+            if type(op) not in self._OPS:
+                return _unsupported(op)
+        left = self._compile(node.left)
+        ops = [self._OPS[type(op)] for op in node.ops]
+        comparators = [self._compile(comparator) for comparator in node.comparators]
+        def thunk():
+            prev_value = left()
+            for op, comparator in zip(ops, comparators):
+                next_value = comparator()
+                if not op(prev_value, next_value):
+                    return False
+                prev_value = next_value
+            return True
+        return thunk
+    def _fold(self, node):
+        # evaluate constant expressions at compile time, or return _UNSET if
+        # the value is only known at run time (or evaluating it fails)
+        if type(node) is ast.Constant:
+            return node.value
+        elif type(node) is ast.BinOp:
+            operands = (self._fold(node.left), self._fold(node.right))
+        elif type(node) is ast.UnaryOp:
+            operands = (self._fold(node.operand),)
+        else:
+            return _UNSET
+        if any(operand is _UNSET for operand in operands):
+            return _UNSET
+        if not _safe_to_fold(type(node.op), operands):
+            return _UNSET
+        try:
+            return self._OPS[type(node.op)](*operands)
+        except Exception:
+            return _UNSET
+    def _compile_BinOp(self, node):
+        value = self._fold(node)
+        if value is not _UNSET:
+            return lambda: value
+        op = self._OPS.get(type(node.op))
+        if op is None:
+            return _unsupported(node.op)
+        left = self._compile(node.left)
+        right = self._compile(node.right)
+        return lambda: op(left(), right())
+    def _compile_UnaryOp(self, node):
+        value = self._fold(node)
+        if value is not _UNSET:
+            return lambda: value
+        op = self._OPS.get(type(node.op))
+        if op is None:
+            return _unsupported(node.op)
+        operand = self._compile(node.operand)
+        return lambda: op(operand())
+    def _compile_Constant(self, node):
+        value = node.value
+        return lambda: value
+    def _compile_If(self, node):
+        test = self._compile(node.test)
+        body = self._compile_body(node.body)
+        orelse = self._compile_body(node.orelse)
+        def thunk():
+            if test():
+                body()
+            else:
+                orelse()
+        return thunk
+    def _compile_While(self, node):
+        test = self._compile(node.test)
+        # FIXME this doesn't deal with breaks
+        body = self._compile_body(node.body)
+        def loop():
+            while test():
+                body()
+        lowered = _NumbaLowerer.lower(node)
+        if lowered is None:
+            return loop
+        names, source, assignments = lowered
+        slots = [self._slot(name) for name in names]
+        values = self._values
+        iterations = 0
+        def run_kernel():
+            # run the rest of the loop as a kernel, a chunk of iterations at a
+            # time so that Ctrl-C still works; returns whether the loop is done
+            nonlocal source
+            inputs = [values[slot] for slot in slots]
+            if not all(_NumbaLowerer.accepts(value) for value in inputs):
+                return False
+            # Numba gives each variable one type for the whole loop, so only
+            # lower loops where Python would never change a variable's type
+            types = {name: type(value) for name, value in zip(names, inputs)}
+            if not _NumbaLowerer.preserves_types(assignments, types):
+                source = None
+                return False
+            kernel = _NumbaLowerer.kernel(source)
+            while True:
+                inputs = [values[slot] for slot in slots]
+                try:
+                    budget, *results = kernel(_NUMBA_CHUNK, *inputs)
+                except Exception:
+                    # the kernel has no side effects, so if Numba cannot type
+                    # it (or it fails) just keep interpreting the loop
+                    source = None
+                    return False
+                for slot, result in zip(slots, results):
+                    values[slot] = result
+                if budget:
+                    return True
+        def thunk():
+            nonlocal iterations
+            while test():
+                body()
+                # only pay for importing Numba and compiling the kernel once
+                # the loop has run long enough to make it worthwhile
+                if source is not None:
+                    iterations += 1
+                    if iterations >= _NUMBA_THRESHOLD:
+                        iterations = 0
+                        if run_kernel():
+                            return
+        return thunk
 
     @staticmethod
-    def run(code):
-        PyliteInterpreter().visit(parse(code))
+    def run(code_or_tree):
+        PyliteInterpreter()._compile(_parse_program(code_or_tree))()
+
+
+# Numba integers wrap around instead of growing, so every arithmetic result in
+# a kernel is checked against this bound; the product of two bounded values
+# cannot overflow 64 bits, and exceeding it sends the loop back to the
+# interpreter
+_NUMBA_BOUND = 2 ** 31
+# how many iterations a loop is interpreted for before it is lowered
+_NUMBA_THRESHOLD = 100000
+# how many iterations a kernel runs for before returning to Python
+_NUMBA_CHUNK = 10 ** 7
+
+class _NumbaLowerer(NodeTransformer):
+    # lower while loops that only do arithmetic on numbers into a Numba
+    # kernel, which takes an iteration budget and the loop variables, and
+    # returns the unused budget and the variables' new values
+    NODES = (
+        ast.While, ast.If, ast.Assign, ast.AugAssign,
+        ast.BoolOp, ast.BinOp, ast.UnaryOp, ast.Compare, ast.Name, ast.Constant,
+        ast.Load, ast.Store, ast.And, ast.Or,
+        ast.Add, ast.Sub, ast.Mult, ast.Div, ast.FloorDiv, ast.Mod,
+        ast.Not, ast.UAdd, ast.USub,
+        ast.Lt, ast.LtE, ast.Eq, ast.NotEq, ast.GtE, ast.Gt,
+    )
+    BOUNDED = '_pylite_bounded'
+    BUDGET = '_pylite_budget'
+    BOUNDED_SOURCE = '\n'.join([
+        'def {}(value):'.format(BOUNDED),
+        '    if abs(value) > {}:'.format(_NUMBA_BOUND),
+        '        raise OverflowError("Value out of bounds for Numba")',
+        '    return value',
+    ])
+    KERNELS = {}
+    def __init__(self):
+        super().__init__()
+        self.names = set()
+        self.assignments = []
+    def generic_visit(self, node):
+        if not isinstance(node, _NumbaLowerer.NODES):
+            raise NotImplementedError('Cannot lower `{}`'.format(type(node).__name__))
+        return super().generic_visit(node)
+    def visit_Name(self, node):
+        self.names.add(node.id)
+        return node
+    def visit_Assign(self, node):
+        if len(node.targets) != 1:
+            raise NotImplementedError('Cannot lower multiple assignment')
+        # Numba would store the result as a number, not as the bool or
+        # operand that Python produces
+        for child in ast.walk(node.value):
+            if isinstance(child, (ast.BoolOp, ast.Compare, ast.Not)):
+                raise NotImplementedError('Cannot lower assigning `{}`'.format(type(child).__name__))
+        self.assignments.append((node.targets[0].id, deepcopy(node.value)))
+        return self.generic_visit(node)
+    def visit_AugAssign(self, node):
+        value = ast.BinOp(left=ast.Name(id=node.target.id, ctx=ast.Load()), op=node.op, right=node.value)
+        return self.visit(ast.copy_location(ast.Assign(targets=[node.target], value=value), node))
+    def visit_BinOp(self, node):
+        node = self.generic_visit(node)
+        return ast.Call(func=ast.Name(id=_NumbaLowerer.BOUNDED, ctx=ast.Load()), args=[node], keywords=[])
+    def visit_Constant(self, node):
+        if not _NumbaLowerer.accepts(node.value):
+            raise NotImplementedError('Cannot lower `{!r}`'.format(node.value))
+        return node
+
+    @staticmethod
+    def accepts(value):
+        return type(value) in (int, float) and abs(value) <= _NUMBA_BOUND
+    @staticmethod
+    def type_of(node, types):
+        # the type Python gives an assigned value, given the variables' types
+        if type(node) is ast.Constant:
+            return type(node.value)
+        elif type(node) is ast.Name:
+            return types[node.id]
+        elif type(node) is ast.UnaryOp:
+            return _NumbaLowerer.type_of(node.operand, types)
+        elif type(node.op) is ast.Div:
+            return float
+        elif float in (_NumbaLowerer.type_of(node.left, types), _NumbaLowerer.type_of(node.right, types)):
+            return float
+        else:
+            return int
+    @staticmethod
+    def preserves_types(assignments, types):
+        return all(
+            _NumbaLowerer.type_of(value, types) is types[name]
+            for name, value in assignments
+        )
+    @staticmethod
+    def lower(node):
+        # return the loop variables, the kernel source and the loop's
+        # assignments, without importing Numba until a kernel is needed
+        if find_spec('numba') is None:
+            return None
+        lowerer = _NumbaLowerer()
+        try:
+            node = lowerer.visit(deepcopy(node))
+        except NotImplementedError:
+            return None
+        if not lowerer.names:
+            return None
+        names = sorted(lowerer.names)
+        source = '\n'.join([
+            'def kernel({}, {}):'.format(_NumbaLowerer.BUDGET, ', '.join(names)),
+            '    while {} > 0 and ({}):'.format(_NumbaLowerer.BUDGET, ast.unparse(node.test)),
+            indent('\n'.join(ast.unparse(statement) for statement in node.body), '        '),
+            '        {} -= 1'.format(_NumbaLowerer.BUDGET),
+            '    return ({}, {},)'.format(_NumbaLowerer.BUDGET, ', '.join(names)),
+        ])
+        return names, source, lowerer.assignments
+    @staticmethod
+    def kernel(source):
+        if source not in _NumbaLowerer.KERNELS:
+            from numba import njit
+            # the helper is also generated, so that Numba always gets a plain
+            # Python function even if this module is compiled
+            namespace = {}
+            exec(_NumbaLowerer.BOUNDED_SOURCE, namespace)
+            exec(source, namespace)
+            namespace[_NumbaLowerer.BOUNDED] = njit(namespace[_NumbaLowerer.BOUNDED])
+            _NumbaLowerer.KERNELS[source] = njit(namespace['kernel'])
+        return _NumbaLowerer.KERNELS[source]
+
+
+def _random_mod(left, right):
+    # randomly confuse modulo with division
+    random = getrandbits(1)
+    if random == 0:
+        return operator.mod(left, right)
+    elif random == 1:
+        return operator.truediv(left, right)
 
 class StochasticPyliteInterpreter(PyliteInterpreter):
+    _OPS = dict(PyliteInterpreter._OPS)
+    _OPS[ast.Mod] = _random_mod
     def __init__(self):
         super().__init__()
     def visit_Name(self, node):
         # randomly use the value of a variable or the name as a string
         name = node.id
         if name in self.env:
-            random = randrange(2)
+            random = getrandbits(1)
             if random == 0:
                 return self.env[name]
             elif random == 1:
                 return name
         raise NameError('Undefined variable `{}`'.format(name))
-
-
-    def visit_Mod(self, node):
-        random = randrange(2)
-        if random == 0:
-            return operator.mod
-        if random == 1:
-            return operator.truediv
-
+    def visit_AugAssign(self, node):
+        # read the target like any other variable, so it can be misread too
+        try:
+            op = node._op_fn
+        except AttributeError:
+            op = self._OPS[type(node.op)]
+        self.env[node.target.id] = op(self.visit(node.target), self.visit(node.value))
 
     def visit_If(self, node):
-        random = randrange(4)
+        random = getrandbits(2)
 
         # handle elif/else statement error: evaluating both the if and elif
         if type(node.orelse[0]).__name__ == "If":
@@ -193,68 +631,27 @@ class StochasticPyliteInterpreter(PyliteInterpreter):
                 # runs neither
                 pass
 
-    def visit_While(self, node):
-        test_result = self.visit(node.test)
-        while test_result:
-            for statement in node.body:
-                # FIXME this doesn't deal with breaks
-                self.visit(statement)
-            test_result = self.visit(node.test)
-
-
-    def visit_Compare(self, node):
-        ops = [self.visit(op) for op in node.ops]
-        values = [self.visit(node.left)]
-        values.extend(self.visit(expr) for expr in node.comparators)
-        result = True
-        for i, (left, right) in enumerate(zip(values[:-1], values[1:])):
-            if not ops[i](left, right):
-                return False
-        return True
-    def visit_Lt(self, node):
-        return operator.lt
-    def visit_Le(self, node):
-        return operator.le
-    def visit_Eq(self, node):
-        return operator.eq
-    def visit_Ne(self, node):
-        return operator.ne
-    def visit_Ge(self, node):
-        return operator.ge
-    def visit_Gt(self, node):
-        return operator.gt
-    def visit_BinOp(self, node):
-        args = [self.visit(node.left), self.visit(node.right)]
-        op = self.visit(node.op)
-        return op(*args)
-    def visit_Add(self, node):
-        return operator.add
-    def visit_Sub(self, node):
-        return operator.sub
-    def visit_Mult(self, node):
-        return operator.mul
-    def visit_Div(self, node):
-        return operator.truediv
-    def visit_FloorDiv(self, node):
-        return operator.floordiv
-    def visit_Pow(self, node):
-        return operator.pow
-    def visit_Str(self, node):
-        return node.s
-    def visit_Num(self, node):
-        return node.n
-
-
-
     @staticmethod
-    def run(code):
-        StochasticPyliteInterpreter().visit(parse(code))
+    def run(code_or_tree):
+        interpreter = StochasticPyliteInterpreter()
+        tree = _parse_private(code_or_tree)
+        interpreter._annotate(tree)
+        interpreter.visit(tree)
 
 
 class BindingInterpreter(PyliteInterpreter):
     def __init__(self):
         super().__init__()
     def visit_BinOp(self, node):
+        # dispatch on the shape of the expression, then each handler only
+        # needs to check the inner operator and its operands
+        handler = BindingInterpreter._PATTERNS.get((type(node.op), type(node.left), type(node.right)))
+        if handler is not None:
+            result = handler(self, node)
+            if result is not None:
+                return result
+        return super().visit_BinOp(node)
+    def _bind_add_binop_num(self, node):
         # check that this is an Add
         # check that the right child is a Num
         # check that the left child is another BinOp
@@ -265,134 +662,132 @@ class BindingInterpreter(PyliteInterpreter):
         #    *    4
         #  /  \
         # 2    3
+        if not _is_number(node.right):
+            return None
+        left_op = type(node.left.op)
 
         # (2 * 3 + 4)
-        if (type(node.op).__name__ == 'Add' and
-                type(node.right).__name__ == 'Num' and
-                type(node.left).__name__ == 'BinOp' and
-                type(node.left.op).__name__ == 'Mult' and
-                type(node.left.left).__name__ == 'Num' and
-                type(node.left.right).__name__ == 'Num'):
+        if (left_op is Mult and
+                _is_number(node.left.left) and
+                _is_number(node.left.right)):
             print('first case mult/add')
             left_left = self.visit(node.left.left)
             left_right = self.visit(node.left.right)
             right = self.visit(node.right)
             return left_left * (left_right + right)
 
+        # (4 / 2 + 1)
+        if (left_op is Div and
+                _is_number(node.left.left) and
+                _is_number(node.left.right)):
+            print('first case division')
+            left_left = self.visit(node.left.left)
+            right = self.visit(node.right)
+            left_right = self.visit(node.left.right)
+            return (left_left / (right + left_right))
+
+        # (4 + 2 / 2 + 9)
+        if (left_op is Add and
+                _is_number(node.left.left) and
+                type(node.left.right) is BinOp and
+                type(node.left.right.op) is Div and
+                _is_number(node.left.right.left) and
+                _is_number(node.left.right.right)):
+            print ('4 term expression')
+            right = self.visit(node.right)
+            left_left = self.visit(node.left.left)
+            left_right_left = self.visit(node.left.right.left)
+            left_right_right = self.visit(node.left.right.right)
+            random = randrange(3)
+            if random == 0:
+                return (((left_left + left_right_left) / left_right_right) + right)
+            if random == 1:
+                return ((left_left + left_right_left) / (left_right_right + right))
+            if random == 2:
+                return (left_left + (left_right_left / (left_right_right + right)))
+        return None
+    def _bind_add_num_binop(self, node):
+        right_op = type(node.right.op)
+        if (not _is_number(node.left) or
+                not _is_number(node.right.left) or
+                not _is_number(node.right.right)):
+            return None
+
         # (2 + 3 * 4)
-        if (type(node.op).__name__ == 'Add' and
-                type(node.left).__name__ == 'Num' and
-                type(node.right).__name__ == 'BinOp' and
-                type(node.right.op).__name__ == 'Mult' and
-                type(node.right.left).__name__ == 'Num' and
-                type(node.right.right).__name__ == 'Num'):
+        if right_op is Mult:
             print('second case mult/add')
             left = self.visit(node.left)
             right_left = self.visit(node.right.left)
             right_right = self.visit(node.right.right)
             return (left + right_left) * right_right
 
+        # (4 + 2 / 2)
+        if right_op is Div:
+            print ('second case division')
+            right_left = self.visit(node.right.left)
+            right_right = self.visit(node.right.right)
+            left = self.visit(node.left)
+            return ((left + right_left)/right_right)
+        return None
+    def _bind_sub_binop_num(self, node):
         # (2 * 3 - 4) = -2
-        if (type(node.op).__name__ == 'Sub' and
-                type(node.right).__name__ == 'Num' and
-                type(node.left).__name__ == 'BinOp' and
-                type(node.left.op).__name__ == 'Mult' and
-                type(node.left.left).__name__ == 'Num' and
-                type(node.left.right).__name__ == 'Num'):
+        if (_is_number(node.right) and
+                type(node.left.op) is Mult and
+                _is_number(node.left.left) and
+                _is_number(node.left.right)):
             print('first case mult/sub')
             left_left = self.visit(node.left.left)
             left_right = self.visit(node.left.right)
             right = self.visit(node.right)
             return left_left * (left_right - right)
-
+        return None
+    def _bind_sub_num_binop(self, node):
         # (2 - 3 * 4) = -4
-        if (type(node.op).__name__ == 'Sub' and
-                type(node.left).__name__ == 'Num' and
-                type(node.right).__name__ == 'BinOp' and
-                type(node.right.op).__name__ == 'Mult' and
-                type(node.right.left).__name__ == 'Num' and
-                type(node.right.right).__name__ == 'Num'):
+        if (_is_number(node.left) and
+                type(node.right.op) is Mult and
+                _is_number(node.right.left) and
+                _is_number(node.right.right)):
             print('second case mult/sub')
             left = self.visit(node.left)
             right_left = self.visit(node.right.left)
             right_right = self.visit(node.right.right)
             return (left - right_left) * right_right
-
-
-        # (4 / 2 + 1)
-        if(type(node.op).__name__ == 'Add' and
-           type(node.right).__name__ == 'Num' and
-           type(node.left).__name__ == 'BinOp' and
-           type(node.left.op).__name__ == 'Div' and
-           type(node.left.left).__name__ == 'Num' and
-           type(node.left.right).__name__ == 'Num'):
-           print('first case division')
-           left_left = self.visit(node.left.left)
-           right = self.visit(node.right)
-           left_right = self.visit(node.left.right)
-           return (left_left / (right + left_right))
-
-        # (4 + 2 / 2)
-        if (type(node.op).__name__ == 'Add' and
-            type(node.right).__name__ == 'BinOp' and
-            type(node.left).__name__ == 'Num' and
-            type(node.right.op).__name__ == 'Div' and
-            type(node.right.left).__name__ == 'Num' and
-            type(node.right.right).__name__ == 'Num'):
-            print ('second case division')
-            right_left = self.visit(node.right.left)
-            right_right = self.visit(node.right.right)
-            left = self.visit(node.left)
-            return ((left + right_left)/right_right)
-
-        # (4 + 2 / 2 + 9)
-        if (type(node.op).__name__ == 'Add' and
-            type(node.left).__name__ == 'BinOp' and
-            type(node.right).__name__ == 'Num' and
-            type(node.left.op).__name__ == 'Add' and
-            type(node.left.left).__name__ == 'Num' and
-            type(node.left.right).__name__ == 'BinOp' and
-            type(node.left.right.op).__name__ == 'Div' and
-            type(node.left.right.left).__name__ == 'Num' and
-            type(node.left.right.right).__name__ == 'Num'):
-            print ('4 term expression')
-            right = self.visit(node.right)
-            left_left = self.visit(node.left.left)
-            left_right_left = self.visit(node.left.right.left)
-            left_right_right = self.visit(node.left.right.right)
-            random = randrange(3)
-            if random == 0:
-                return (((left_left + left_right_left) / left_right_right) + right)
-            if random == 1:
-                return ((left_left + left_right_left) / (left_right_right + right))
-            if random == 2:
-                return (left_left + (left_right_left / (left_right_right + right)))
-
-        else:
-            args = [self.visit(node.left), self.visit(node.right)]
-            op = self.visit(node.op)
-            return op(*args)
+        return None
+    # keyed on (operator, left child, right child); handlers still check
+    # that the Constant children are numbers
+    _PATTERNS = {
+        (Add, BinOp, Constant): _bind_add_binop_num,
+        (Add, Constant, BinOp): _bind_add_num_binop,
+        (Sub, BinOp, Constant): _bind_sub_binop_num,
+        (Sub, Constant, BinOp): _bind_sub_num_binop,
+    }
     @staticmethod
-    def run(code):
-        BindingInterpreter().visit(parse(code))
+    def run(code_or_tree):
+        interpreter = BindingInterpreter()
+        tree = _parse_private(code_or_tree)
+        interpreter._annotate(tree)
+        interpreter.visit(tree)
 
 def main():
     arg_parser = ArgumentParser()
     arg_parser.add_argument('line_or_file')
     arg_parser.add_argument('--interp', choices=('correct', 'stochastic', 'binding'), default='correct')
     args = arg_parser.parse_args()
-    if file_exists(args.line_or_file):
-        with open(args.line_or_file) as fd:
-            code = fd.read()
-    else:
+    try:
+        fd = open(args.line_or_file, encoding='utf-8')
+    except (OSError, ValueError):
+        # not a readable file, so treat it as code
         code = args.line_or_file
+    else:
+        with fd:
+            code = fd.read()
     if args.interp == 'correct':
         interpreter = PyliteInterpreter
     elif args.interp == 'stochastic':
         interpreter = StochasticPyliteInterpreter
     elif args.interp == 'binding':
         interpreter = BindingInterpreter
-    interpreter.run(parse(code))
+    interpreter.run(code)
 
 if __name__ == '__main__':
     main()